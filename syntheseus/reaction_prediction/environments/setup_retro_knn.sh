@@ -5,4 +5,3 @@ source setup_local_retro.sh
 
 # Install extra dependencies specific to RetroKNN.
 conda install faiss-gpu -c pytorch -y
-pip install torch-scatter -f https://data.pyg.org/whl/torch-1.10.0+cu113.html
@@ -17,13 +17,28 @@ from syntheseus.reaction_prediction.utils.inference import get_unique_file_in_di
 class RetroKNNModel(LocalRetroModel):
     """Warpper for RetroKNN model."""
 
-    def __init__(self, model_dir: Union[str, Path], device: str = "cuda:0") -> None:
+    def __init__(
+        self,
+        model_dir: Union[str, Path],
+        device: str = "cuda:0",
+        compile_adapter: bool = False,
+        bf16_adapter: bool = False,
+    ) -> None:
         """Initializes the RetroKNN model wrapper.
 
         Assumed format of the model directory:
         - `model_dir/local_retro` contains the files needed to load the LocalRetro wrapper
         - `model_dir/knn/` contains the adapter checkpoint as the only `*.pt` file
         - `model_dir/knn/datastore` contains the data store files
+
+        The data stores (`data.atom_idx` and `data.bond_idx`) can be any faiss index that supports
+        GPU cloning; for large data stores a compressed index such as `IndexIVFPQ` can be used in
+        place of a flat index to reduce memory usage and search time.
+
+        If `compile_adapter` is set, the adapter is wrapped with `torch.compile` (requires
+        PyTorch 2.0+), which fuses its layers into fewer kernels at the cost of a slower first call.
+        If `bf16_adapter` is set, the adapter's linear layers run under bf16 autocast on GPUs that
+        support it, which is faster but may slightly change the predictions.
         """
         import torch
 
@@ -37,21 +52,37 @@ class RetroKNNModel(LocalRetroModel):
         import faiss
         import faiss.contrib.torch_utils  # make faiss available for torch tensors
 
+        # Keep the data stores on the same GPU as the model, so that `search` can consume the
+        # CUDA feature tensors directly and return CUDA results without host round-trips.
+        gpu_id = torch.device(self.args["device"]).index or 0
+        self._gpu_resources = faiss.StandardGpuResources()
+
         def load_data_store(path: Path):
             index = faiss.read_index(str(path), faiss.IO_FLAG_ONDISK_SAME_DIR)
-            res = faiss.StandardGpuResources()
             co = faiss.GpuClonerOptions()
             co.useFloat16 = True
-            return faiss.index_cpu_to_gpu(res, 0, index, co)
+            return faiss.index_cpu_to_gpu(self._gpu_resources, gpu_id, index, co)
 
         self.atom_store = load_data_store(datastore_path / "data.atom_idx")
         self.bond_store = load_data_store(datastore_path / "data.bond_idx")
-        self.raw_data = np.load(datastore_path / "data.npz")
 
-        self.adapter = Adapter(self.model.linearB.weight.shape[0], k=32).to(self.args["device"])
+        raw_data = np.load(datastore_path / "data.npz")
+        self.atom_output_label = torch.from_numpy(raw_data["atom_output_label"]).to(
+            self.args["device"]
+        )
+        self.bond_output_label = torch.from_numpy(raw_data["bond_output_label"]).to(
+            self.args["device"]
+        )
+
+        self.adapter = Adapter(self.model.linearB.weight.shape[0], k=32, bf16=bf16_adapter).to(
+            self.args["device"]
+        )
         self.adapter.load_state_dict(torch.load(adapter_chkpt_path))
         self.adapter.eval()
 
+        if compile_adapter:
+            self.adapter = torch.compile(self.adapter, dynamic=True)
+
     def _forward_localretro(self, bg):
         from local_retro.scripts.model_utils import pair_atom_feats, unbatch_feats, unbatch_mask
 
@@ -95,18 +126,21 @@ class RetroKNNModel(LocalRetroModel):
         batch_atom_prob_nn = torch.nn.Softmax(dim=1)(batch_atom_logits)
         batch_bond_prob_nn = torch.nn.Softmax(dim=1)(batch_bond_logits)
 
-        atom_output_label = torch.from_numpy(self.raw_data["atom_output_label"]).to(
-            self.args["device"]
-        )
-        bond_output_label = torch.from_numpy(self.raw_data["bond_output_label"]).to(
-            self.args["device"]
-        )
-
         batch_atom_prob_knn = knn_prob(
-            atom_feats, self.atom_store, atom_output_label, batch_atom_logits.shape[1], 32, node_t
+            atom_feats,
+            self.atom_store,
+            self.atom_output_label,
+            batch_atom_logits.shape[1],
+            32,
+            node_t,
         )
         batch_bond_prob_knn = knn_prob(
-            bond_feats, self.bond_store, bond_output_label, batch_bond_logits.shape[1], 32, edge_t
+            bond_feats,
+            self.bond_store,
+            self.bond_output_label,
+            batch_bond_logits.shape[1],
+            32,
+            edge_t,
         )
 
         batch_atom_logits = node_p * batch_atom_prob_nn + (1 - node_p) * batch_atom_prob_knn
@@ -3,42 +3,45 @@ import torch.nn.functional as F
 from torch import nn
 
 
-def reorder_efeat(g, efeat):
+def _compute_edge_indices(g):
+    """Returns the edge-to-adjacency permutation and the atom pair indices in adjacency order."""
     sg = g.remove_self_loop()  # in case g includes self-loop
-    atom_pair_list = torch.transpose(sg.adjacency_matrix().coalesce().indices(), 0, 1).cpu()
-    atom_pair_idx1 = atom_pair_list[:, 0].tolist()
-    atom_pair_idx2 = atom_pair_list[:, 1].tolist()
+    atom_pair_idx1, atom_pair_idx2 = sg.adjacency_matrix().coalesce().indices().to(g.device).long()
+
+    # The graph may use int32 ids; use int64 so that the keys below cannot overflow.
+    start_idx, end_idx = (idx.long() for idx in sg.edges())
 
-    num_edges = len(atom_pair_idx1)
+    assert len(atom_pair_idx1) == len(start_idx)
 
-    start_idx, end_idx = sg.edges()
-    start_idx = start_idx.cpu().tolist()
-    end_idx = end_idx.cpu().tolist()
+    if len(start_idx) == 0:
+        return start_idx, atom_pair_idx1, atom_pair_idx2
 
-    assert num_edges == len(start_idx)
+    # Encode each (start, end) pair as a single integer key, then match the edge order against the
+    # adjacency order by binary search, keeping everything on the device `g` lives on.
+    num_nodes = sg.num_nodes()
+    adjacency_keys = atom_pair_idx1 * num_nodes + atom_pair_idx2
+    edge_keys = start_idx * num_nodes + end_idx
 
-    idx_map = [-1] * num_edges
+    sorted_adjacency_keys, perm = adjacency_keys.sort()
+    pos = torch.searchsorted(sorted_adjacency_keys, edge_keys).clamp_(max=len(perm) - 1)
 
-    for i in range(num_edges):
-        s = start_idx[i]
-        t = end_idx[i]
+    if not torch.equal(sorted_adjacency_keys[pos], edge_keys):
+        raise Exception("Not found")
 
-        for j in range(num_edges):
-            if atom_pair_idx1[j] == s and atom_pair_idx2[j] == t:
-                idx_map[i] = j
-                break
-        else:
-            raise Exception("Not found")
+    return perm[pos], atom_pair_idx1, atom_pair_idx2
 
-    idx_map = torch.LongTensor(idx_map).cuda()
-    return efeat[idx_map, ...]
+
+def reorder_efeat(g, efeat):
+    idx_map, _, _ = _compute_edge_indices(g)
+    return efeat.index_select(0, idx_map.to(efeat.device))
 
 
 class Adapter(nn.Module):
-    def __init__(self, dim, k=32):
+    def __init__(self, dim, k=32, bf16=False):
         from dgl.nn import GINEConv
 
         super().__init__()
+        self.bf16 = bf16
         self.gnn = GINEConv(nn.Linear(dim, dim))
         self.node_proj = nn.Linear(dim, 2)  # [tmp, p]
         self.edge_proj = nn.Linear(dim, 2)  # [tmp, p]
@@ -59,26 +62,38 @@ class Adapter(nn.Module):
         nn.init.constant_(self.edge_proj.bias[0], 10.0)
 
     def forward(self, g, nfeat, efeat, ndist, edist):
-        from local_retro.scripts.model_utils import pair_atom_feats
+        idx_map, atom_pair_idx1, atom_pair_idx2 = _compute_edge_indices(g)
 
-        efeat = reorder_efeat(g, efeat)
+        efeat = efeat.index_select(0, idx_map)
         x = self.gnn(g, nfeat, efeat)
-        x = F.relu(x)
 
-        ndist = F.relu(self.node_dist_in_proj(ndist))
-        edist = F.relu(self.edge_dist_in_proj(edist))
-
-        node_x = torch.cat((x, ndist), dim=-1)
-        node_x = self.node_ffn(node_x)
-        node_x = F.relu(node_x)
-        node_x = self.node_proj(node_x)
-
-        edge_x = pair_atom_feats(g, x)
-        edge_x = F.relu(edge_x)
-        edge_x = torch.cat((edge_x, edist), dim=-1)
-        edge_x = self.edge_ffn(edge_x)
-        edge_x = F.relu(edge_x)
-        edge_x = self.edge_proj(edge_x)
+        # Optionally run the linear layers in bf16 where supported, which halves the memory traffic
+        # and uses tensor cores. The outputs are cast back to fp32 before computing temperatures and
+        # weights, but results may still differ slightly from fp32.
+        use_bf16 = self.bf16 and x.is_cuda and torch.cuda.is_bf16_supported()
+        with torch.autocast(x.device.type, dtype=torch.bfloat16, enabled=use_bf16):
+            x = F.relu(x)
+
+            ndist = F.relu(self.node_dist_in_proj(ndist))
+            edist = F.relu(self.edge_dist_in_proj(edist))
+
+            node_x = torch.cat((x, ndist), dim=-1)
+            node_x = self.node_ffn(node_x)
+            node_x = F.relu(node_x)
+            node_x = self.node_proj(node_x)
+
+            # Same as `pair_atom_feats` from LocalRetro, but reusing the indices computed above.
+            edge_x = torch.cat(
+                (x.index_select(0, atom_pair_idx1), x.index_select(0, atom_pair_idx2)), dim=-1
+            )
+            edge_x = F.relu(edge_x)
+            edge_x = torch.cat((edge_x, edist), dim=-1)
+            edge_x = self.edge_ffn(edge_x)
+            edge_x = F.relu(edge_x)
+            edge_x = self.edge_proj(edge_x)
+
+        node_x = node_x.float()
+        edge_x = edge_x.float()
 
         node_t = torch.clamp(node_x[:, 0], 1, 100)
         node_p = torch.sigmoid(node_x[:, 1])
@@ -86,21 +101,22 @@ class Adapter(nn.Module):
         edge_t = torch.clamp(edge_x[:, 0], 1, 100)
         edge_p = torch.sigmoid(edge_x[:, 1])
 
-        return (r.unsqueeze(-1) for r in (node_t, node_p, edge_t, edge_p))
+        return tuple(r.unsqueeze(-1) for r in (node_t, node_p, edge_t, edge_p))
 
 
 def knn_prob(feats, store, lables, max_idx, k=32, temperature=5):
-    from torch_scatter import scatter
-
     dis, idx = store.search(feats, k)  # [B, K]
-    pred = lables[idx].unsqueeze(-1)  # [B, K, 1]
+    pred = lables[idx]  # [B, K]
 
-    re_compute_dists = -1 * dis
-    knn_weight = torch.softmax(re_compute_dists / temperature, dim=-1).unsqueeze(-1)  # [B, K, 1]
+    knn_weight = F.softmin(dis / temperature, dim=-1)  # [B, K]
 
+    # Flatten (batch, label) into a single index so the reduction is one `index_add_` over a
+    # contiguous buffer, which parallelizes better than `scatter_add_` along a non-leading dim.
     bsz = feats.shape[0]
-    output = torch.zeros(bsz, k, max_idx).to(feats)
+    batch_offset = torch.arange(bsz, device=pred.device).unsqueeze(-1) * max_idx  # [B, 1]
+    flat_idx = (batch_offset + pred).reshape(-1)  # [B * K]
 
-    scatter(src=knn_weight, out=output, index=pred, dim=-1)
+    output = torch.zeros(bsz * max_idx, device=feats.device, dtype=feats.dtype)
+    output.index_add_(0, flat_idx, knn_weight.reshape(-1).to(output.dtype))
 
-    return output.sum(dim=1)
+    return output.view(bsz, max_idx)
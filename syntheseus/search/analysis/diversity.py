@@ -2,8 +2,13 @@ from __future__ import annotations
 
 import logging
 import random
-from collections.abc import Collection
-from typing import Callable, Optional
+from collections import defaultdict
+from collections.abc import Collection, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Callable, Optional
+
+import numpy as np
 
 from syntheseus.search.chem import BackwardReaction, Molecule
 from syntheseus.search.graph.route import SynthesisGraph
@@ -20,6 +25,7 @@ def estimate_packing_number(
     max_packing_number: Optional[int] = None,
     num_tries: int = 100,
     random_state: Optional[random.Random] = None,
+    num_processes: int = 0,
 ) -> list[SynthesisGraph]:
     """
     Estimate packing number of a set of routes,
@@ -43,7 +49,12 @@ def estimate_packing_number(
             larger than this value is found.
             If None, the algorithm will run until completion.
         num_tries: the number of random restarts to perform.
-        random_state: random state to use for shuffling routes.
+        random_state: random state used to seed the shuffling of routes.
+        num_processes: number of processes used to compute the pairwise distances
+            between routes (0 means no multiprocessing). This is only used when
+            `max_packing_number` is None (otherwise distances are computed lazily),
+            for distance metrics not defined in this module (which are vectorized),
+            and requires the metric to be picklable.
 
     Returns:
         A set of routes with the largest packing number found.
@@ -61,24 +72,48 @@ def estimate_packing_number(
     # Initialize random state
     random_state = random_state or random.Random()
 
-    # Try to get best packing set
-    best_packing_set: list[SynthesisGraph] = list()
+    # Routes with the same reactions are at distance 0 from each other, so at most one of them
+    # can be in a packing set (unless radius < 0). Remove duplicates to avoid redundant work.
     route_list = list(routes)
+    if radius >= 0:
+        unique_routes: dict[frozenset[BackwardReaction], SynthesisGraph] = dict()
+        for route in route_list:
+            unique_routes.setdefault(_get_reactions(route), route)
+        route_list = list(unique_routes.values())
+
+    # The greedy algorithm only needs to know which pairs of routes are within the radius.
+    # If the search may stop early, distances are only computed (once) when needed.
+    # Otherwise all pairs are needed eventually, so they are computed upfront in bulk.
+    construct_packing_set: Callable[[list[int]], list[int]]
+    if max_packing_number is not None:
+        construct_packing_set = partial(
+            _lazy_greedy_construct_packing_set,
+            conflicts_with_packing_set=_lazy_conflict_check(route_list, distance_metric, radius),
+            max_packing_number=max_packing_number,
+        )
+    else:
+        construct_packing_set = partial(
+            _greedy_construct_packing_set,
+            conflicts=_pairwise_conflicts(
+                route_list, distance_metric, radius, num_processes=num_processes
+            ),
+            max_packing_number=max_packing_number,
+        )
+
+    # Draw the route orders for all tries at once (gives a random restart to greedy algorithm).
+    # The numpy generator is seeded from `random_state` so results are reproducible.
+    rng = np.random.default_rng(random_state.getrandbits(64))
+    permutations = np.argsort(rng.random((num_tries, len(route_list))), axis=1)
+
+    # Try to get best packing set
+    best_packing_set: list[int] = list()
     for try_idx in range(num_tries):
         if max_packing_number is not None and len(best_packing_set) >= max_packing_number:
             logger.debug("Stopping early because max packing number has been reached.")
             break  # no point trying further since the max packing number has been reached
 
-        # Shuffle routes (gives a random restart to greedy algorithm)
-        random_state.shuffle(route_list)
-
         # Construct a packing set and check whether it is better than the previous one
-        packing_set = _recursive_construct_packing_set(
-            route_list,
-            radius,
-            distance_metric,
-            max_packing_number,
-        )
+        packing_set = construct_packing_set(permutations[try_idx].tolist())
         logger.debug(
             f"Run #{try_idx+1}/{num_tries}:"
             f" Found packing set of size {len(packing_set)}."
@@ -88,82 +123,175 @@ def estimate_packing_number(
             logger.debug("This is the new best.")
             best_packing_set = packing_set
 
-    return best_packing_set
+    return [route_list[idx] for idx in best_packing_set]
+
+
+def _pairwise_conflicts(
+    routes: list[SynthesisGraph],
+    distance_metric: ROUTE_DISTANCE_METRIC,
+    radius: float,
+    num_processes: int = 0,
+) -> np.ndarray:
+    """
+    Compute a boolean matrix which is True for all pairs of routes within `radius` of each other.
+    Distances are computed one row (or block of rows) at a time and thresholded immediately,
+    so no dense matrix of distances is ever stored.
+
+    For the set-based distances defined in this module, the intersection sizes between a route
+    and all other routes are counted using an index from each item to the routes containing it.
+    For any other distance metric, it is called once for each (unordered) pair of routes,
+    optionally splitting the rows of the matrix between `num_processes` processes.
+    """
+
+    num_routes = len(routes)
+    conflicts = np.zeros((num_routes, num_routes), dtype=bool)
+
+    if distance_metric in _SET_DISTANCE_METRICS:
+        get_set, set_distance_from_counts = _SET_DISTANCE_METRICS[distance_metric]
+
+        # Index which routes contain each item
+        route_sets = [get_set(route) for route in routes]
+        item_to_routes: dict[Any, list[int]] = defaultdict(list)
+        for route_idx, route_set in enumerate(route_sets):
+            for item in route_set:
+                item_to_routes[item].append(route_idx)
+        item_to_route_array = {
+            item: np.asarray(route_idxs, dtype=np.intp)
+            for item, route_idxs in item_to_routes.items()
+        }
+        set_sizes = np.asarray([len(route_set) for route_set in route_sets], dtype=np.int64)
+
+        for route_idx, route_set in enumerate(route_sets):
+            intersection_sizes = np.zeros(num_routes, dtype=np.int64)
+            for item in route_set:
+                intersection_sizes[item_to_route_array[item]] += 1
+            union_sizes = set_sizes[route_idx] + set_sizes - intersection_sizes
+            conflicts[route_idx] = (
+                set_distance_from_counts(intersection_sizes, union_sizes) <= radius
+            )
+        return conflicts
+
+    compute_rows = partial(_upper_triangular_conflict_rows, routes, distance_metric, radius)
+    if num_processes == 0:
+        row_chunks = [list(range(num_routes))]
+        row_blocks = [compute_rows(row_chunks[0])]
+    else:
+        # Later rows have fewer entries to compute, so interleave the rows to balance the work
+        row_chunks = [
+            list(range(start, num_routes, num_processes)) for start in range(num_processes)
+        ]
+        with ProcessPoolExecutor(num_processes) as executor:
+            row_blocks = list(executor.map(compute_rows, row_chunks))
+
+    for rows, row_block in zip(row_chunks, row_blocks):
+        conflicts[rows] = row_block
+    return conflicts | conflicts.T
 
 
-def _recursive_construct_packing_set(
+def _upper_triangular_conflict_rows(
     routes: list[SynthesisGraph],
+    distance_metric: ROUTE_DISTANCE_METRIC,
     radius: float,
+    rows: Sequence[int],
+) -> np.ndarray:
+    """Compute the given rows of the upper triangle of the pairwise conflict matrix."""
+    row_block = np.zeros((len(rows), len(routes)), dtype=bool)
+    for block_idx, i in enumerate(rows):
+        for j in range(i + 1, len(routes)):
+            row_block[block_idx, j] = distance_metric(routes[i], routes[j]) <= radius
+    return row_block
+
+
+def _lazy_conflict_check(
+    routes: list[SynthesisGraph],
     distance_metric: ROUTE_DISTANCE_METRIC,
-    max_packing_number: Optional[int] = None,
-) -> list[SynthesisGraph]:
+    radius: float,
+) -> Callable[[int, list[int]], bool]:
     """
-    Recursive helper function for estimate_packing_number which finds a packing set.
+    Return a function checking whether a route conflicts with any route in a packing set,
+    which only evaluates the distance metric when needed (and at most once per pair of routes).
+    """
+
+    cache: dict[tuple[int, int], bool] = dict()
+
+    def conflicts_with_packing_set(route: int, packing_set: list[int]) -> bool:
+        for other_route in packing_set:
+            key = (route, other_route) if route < other_route else (other_route, route)
+            if key not in cache:
+                cache[key] = distance_metric(routes[key[0]], routes[key[1]]) <= radius
+            if cache[key]:
+                return True
+        return False
 
-    If <= 1 route is provided, the packing set is just the set of routes.
-    If >= 2 routes are provided, then the list is divided into two subsets
-    and the second subset is merged into the first,
-    which requires at most (N/2)^2 distance computations.
+    return conflicts_with_packing_set
+
+
+def _greedy_construct_packing_set(
+    routes: list[int],
+    conflicts: np.ndarray,
+    max_packing_number: Optional[int] = None,
+) -> list[int]:
+    """
+    Helper function for estimate_packing_number which finds a packing set.
+    Routes are given as indices into `conflicts`, a boolean matrix which is True
+    for all pairs of routes which are within the radius of each other.
+
+    Routes are visited in order, and each route is added to the packing set
+    if it does not conflict with any route already in the set.
+    This is done by keeping track of all routes that conflict with the packing set,
+    so each route requires O(1) work to check and O(N) (vectorized) work to add.
     """
 
     assert (
         max_packing_number is None or max_packing_number > 0
     ), "Max packing number must be positive."
 
-    # Base cases:
-    if len(routes) <= 1:
-        return list(routes)
-
-    # Recursive case:
-    # first calculate packing set for both halves
-    cutoff_idx = len(routes) // 2
-    route_set1 = _recursive_construct_packing_set(
-        routes[:cutoff_idx],
-        radius,
-        distance_metric,
-        max_packing_number,
-    )
-    route_set2 = _recursive_construct_packing_set(
-        routes[cutoff_idx:],
-        radius,
-        distance_metric,
-        max_packing_number,
-    )
+    packing_set: list[int] = list()
+    blocked = np.zeros(conflicts.shape[0], dtype=bool)
+    for route in routes:
+        # Optionally break early if there are too many routes
+        if max_packing_number is not None and len(packing_set) >= max_packing_number:
+            break
+
+        # Add route only if it is far enough from ALL routes in the packing set
+        if not blocked[route]:
+            packing_set.append(route)
+            blocked |= conflicts[route]
+
+    return packing_set
+
+
+def _lazy_greedy_construct_packing_set(
+    routes: list[int],
+    conflicts_with_packing_set: Callable[[int, list[int]], bool],
+    max_packing_number: Optional[int] = None,
+) -> list[int]:
+    """
+    Same as `_greedy_construct_packing_set`, but instead of a precomputed conflict matrix
+    `conflicts_with_packing_set` checks whether a route is within the radius of any route
+    in the current packing set (so distances can be computed only when needed).
+    """
+
     assert (
-        max_packing_number is None or len(route_set1) <= max_packing_number
-    ), "Max packing number exceeded in recursive call."
-
-    # If route set 1 is smaller than route set 2, switch them.
-    # This is done because we will merge route set 2 into route set 1 below,
-    # and this guarantees that the packing set is at least as large as the
-    # largest packing set for the two halves here
-    if len(route_set1) < len(route_set2):
-        route_set1, route_set2 = route_set2, route_set1
-
-    # Which routes from set 2 can be merged into set 1?
-    routes_to_merge: list[SynthesisGraph] = list()
-    for route2 in route_set2:
+        max_packing_number is None or max_packing_number > 0
+    ), "Max packing number must be positive."
+
+    packing_set: list[int] = list()
+    for route in routes:
         # Optionally break early if there are too many routes
-        if (
-            max_packing_number is not None
-            and len(route_set1) + len(routes_to_merge) >= max_packing_number
-        ):
+        if max_packing_number is not None and len(packing_set) >= max_packing_number:
             break
 
-        for route1 in route_set1:
-            if distance_metric(route1, route2) <= radius:
-                # If route2 is too close to ANY route in route_set1,
-                # then it cannot be merged
-                break
-        else:
-            routes_to_merge.append(route2)
+        # Add route only if it is far enough from ALL routes in the packing set
+        if not conflicts_with_packing_set(route, packing_set):
+            packing_set.append(route)
 
-    return route_set1 + routes_to_merge
+    return packing_set
 
 
 def _jaccard_distance(
-    set1: set,
-    set2: set,
+    set1: frozenset,
+    set2: frozenset,
 ) -> float:
     intersection = set1 & set2
     union = set1 | set2
@@ -173,16 +301,37 @@ def _jaccard_distance(
         return 1.0 - len(intersection) / len(union)
 
 
-def _get_reactions(route: SynthesisGraph) -> set[BackwardReaction]:
-    return set(route._graph.nodes)
+def _symmetric_difference_distance(
+    set1: frozenset,
+    set2: frozenset,
+) -> float:
+    # Equal to len(set1 ^ set2), but without constructing the symmetric difference set
+    return len(set1) + len(set2) - 2 * len(set1 & set2)
+
+
+def _get_sets(route: SynthesisGraph) -> tuple[frozenset[BackwardReaction], frozenset[Molecule]]:
+    """
+    Return the sets of reactions and molecules in a route, computed in a single pass
+    over the route and cached on the route object (along with the route's size,
+    to detect routes modified after caching).
+    """
+    cached = getattr(route, "_cached_sets", None)
+    if cached is None or cached[0] != len(route):
+        all_mols: set[Molecule] = set()
+        for rxn in route._graph.nodes:
+            all_mols.add(rxn.product)
+            all_mols.update(rxn.reactants)
+        cached = (len(route), frozenset(route._graph.nodes), frozenset(all_mols))
+        route._cached_sets = cached  # type: ignore[attr-defined]
+    return cached[1], cached[2]
+
+
+def _get_reactions(route: SynthesisGraph) -> frozenset[BackwardReaction]:
+    return _get_sets(route)[0]
 
 
-def _get_molecules(route: SynthesisGraph) -> set[Molecule]:
-    all_mols: set[Molecule] = set()
-    for rxn in route._graph.nodes:
-        all_mols.add(rxn.product)
-        all_mols.update(rxn.reactants)
-    return all_mols
+def _get_molecules(route: SynthesisGraph) -> frozenset[Molecule]:
+    return _get_sets(route)[1]
 
 
 def reaction_jaccard_distance(
@@ -224,7 +373,7 @@ def reaction_symmetric_difference_distance(
     # Get sets of reactions
     reactions1 = _get_reactions(route1)
     reactions2 = _get_reactions(route2)
-    return len(reactions1 ^ reactions2)
+    return _symmetric_difference_distance(reactions1, reactions2)
 
 
 def molecule_symmetric_difference_distance(
@@ -238,4 +387,42 @@ def molecule_symmetric_difference_distance(
     # Get sets of reactions
     molecules1 = _get_molecules(route1)
     molecules2 = _get_molecules(route2)
-    return len(molecules1 ^ molecules2)
+    return _symmetric_difference_distance(molecules1, molecules2)
+
+
+def _jaccard_distance_from_counts(
+    intersection_sizes: np.ndarray,
+    union_sizes: np.ndarray,
+) -> np.ndarray:
+    """Vectorized version of `_jaccard_distance` from precomputed set sizes."""
+    # Where both sets are empty the distance is 0
+    return 1.0 - np.divide(
+        intersection_sizes,
+        union_sizes,
+        out=np.ones(union_sizes.shape, dtype=np.float64),
+        where=union_sizes > 0,
+    )
+
+
+def _symmetric_difference_distance_from_counts(
+    intersection_sizes: np.ndarray,
+    union_sizes: np.ndarray,
+) -> np.ndarray:
+    return union_sizes - intersection_sizes
+
+
+_SET_DISTANCE_METRICS: dict[
+    ROUTE_DISTANCE_METRIC,
+    tuple[Callable[[SynthesisGraph], frozenset], Callable[[np.ndarray, np.ndarray], np.ndarray]],
+] = {
+    reaction_jaccard_distance: (_get_reactions, _jaccard_distance_from_counts),
+    molecule_jaccard_distance: (_get_molecules, _jaccard_distance_from_counts),
+    reaction_symmetric_difference_distance: (
+        _get_reactions,
+        _symmetric_difference_distance_from_counts,
+    ),
+    molecule_symmetric_difference_distance: (
+        _get_molecules,
+        _symmetric_difference_distance_from_counts,
+    ),
+}
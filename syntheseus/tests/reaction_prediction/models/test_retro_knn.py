@@ -0,0 +1,119 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+dgl = pytest.importorskip("dgl")
+
+from syntheseus.reaction_prediction.models.retro_knn import knn_prob, reorder_efeat  # noqa: E402
+
+
+def reorder_efeat_reference(g, efeat):
+    """Original (quadratic) implementation of `reorder_efeat`, run on CPU."""
+    sg = g.remove_self_loop()
+    atom_pair_list = torch.transpose(sg.adjacency_matrix().coalesce().indices(), 0, 1)
+    atom_pair_idx1 = atom_pair_list[:, 0].tolist()
+    atom_pair_idx2 = atom_pair_list[:, 1].tolist()
+
+    start_idx, end_idx = sg.edges()
+    start_idx = start_idx.tolist()
+    end_idx = end_idx.tolist()
+
+    idx_map = []
+    for s, t in zip(start_idx, end_idx):
+        for j in range(len(atom_pair_idx1)):
+            if atom_pair_idx1[j] == s and atom_pair_idx2[j] == t:
+                idx_map.append(j)
+                break
+        else:
+            raise Exception("Not found")
+
+    return efeat[torch.LongTensor(idx_map)]
+
+
+def make_molecule_graph(bonds, num_atoms, idtype):
+    """Make a graph with edges in both directions for each bond (in shuffled order) and self-loops."""
+    src = [a for a, b in bonds] + [b for a, b in bonds]
+    dst = [b for a, b in bonds] + [a for a, b in bonds]
+    perm = torch.randperm(len(src)).tolist()
+
+    g = dgl.graph(
+        ([src[i] for i in perm], [dst[i] for i in perm]), num_nodes=num_atoms, idtype=idtype
+    )
+    return dgl.add_self_loop(g)
+
+
+@pytest.mark.parametrize("idtype", [torch.int32, torch.int64])
+def test_reorder_efeat(idtype) -> None:
+    torch.manual_seed(0)
+
+    # Batch of a ring, a chain, and a single atom with no bonds
+    g = dgl.batch(
+        [
+            make_molecule_graph([(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (5, 0)], 6, idtype),
+            make_molecule_graph([(0, 1), (1, 2), (1, 3)], 4, idtype),
+            make_molecule_graph([], 1, idtype),
+        ]
+    )
+    assert g.idtype == idtype
+
+    efeat = torch.randn(g.remove_self_loop().num_edges(), 8)
+    assert torch.equal(reorder_efeat(g, efeat), reorder_efeat_reference(g, efeat))
+
+
+def test_reorder_efeat_not_found(monkeypatch) -> None:
+    # Make the adjacency matrix describe the reversed graph, so the (directed) edges cannot be found
+    adjacency_matrix = dgl.DGLGraph.adjacency_matrix
+    monkeypatch.setattr(
+        dgl.DGLGraph,
+        "adjacency_matrix",
+        lambda self, *args, **kwargs: adjacency_matrix(dgl.reverse(self), *args, **kwargs),
+    )
+
+    g = dgl.graph(([0, 1], [1, 2]), num_nodes=3)
+    with pytest.raises(Exception, match="Not found"):
+        reorder_efeat(g, torch.randn(2, 8))
+
+
+class FixedStore:
+    """Stub for a faiss index which always returns the same search results."""
+
+    def __init__(self, dis, idx):
+        self.dis = dis
+        self.idx = idx
+
+    def search(self, feats, k):
+        assert feats.shape[0] == self.idx.shape[0] and k == self.idx.shape[1]
+        return self.dis, self.idx
+
+
+def knn_prob_reference(dis, idx, labels, max_idx, temperature):
+    """Dense version of `knn_prob` which scatters into a [B, K, max_idx] tensor and sums over K."""
+    knn_weight = torch.softmax(-dis / temperature, dim=-1)
+
+    bsz, k = idx.shape
+    output = torch.zeros(bsz, k, max_idx)
+    for b in range(bsz):
+        for j in range(k):
+            output[b, j, labels[idx[b, j]]] += knn_weight[b, j]
+
+    return output.sum(dim=1)
+
+
+@pytest.mark.parametrize("per_sample_temperature", [False, True])
+def test_knn_prob(per_sample_temperature: bool) -> None:
+    torch.manual_seed(0)
+    bsz, k, store_size, max_idx = 5, 8, 50, 6
+
+    dis = torch.rand(bsz, k) * 10
+    idx = torch.randint(store_size, (bsz, k))
+    labels = torch.randint(max_idx, (store_size,))  # few labels, so some repeat within the top-k
+
+    if per_sample_temperature:
+        temperature = torch.rand(bsz, 1) * 5 + 1
+    else:
+        temperature = 5
+
+    output = knn_prob(torch.randn(bsz, 16), FixedStore(dis, idx), labels, max_idx, k, temperature)
+    expected = knn_prob_reference(dis, idx, labels, max_idx, temperature)
+
+    assert output.shape == (bsz, max_idx)
+    assert torch.allclose(output, expected, atol=1e-6)
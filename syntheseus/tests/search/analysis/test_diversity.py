@@ -110,3 +110,136 @@ def test_max_packing_number(
         random_state=random.Random(100),
     )
     assert len(distinct_routes) == expected_packing_number
+
+
+def test_distance_computed_once_per_pair(sample_synthesis_routes: list[SynthesisGraph]) -> None:
+    """Test that the distance between each pair of routes is computed at most once."""
+
+    computed_pairs: list[frozenset[int]] = []
+
+    def counting_metric(route1: SynthesisGraph, route2: SynthesisGraph) -> float:
+        computed_pairs.append(frozenset((id(route1), id(route2))))
+        return reaction_jaccard_distance(route1, route2)
+
+    estimate_packing_number(
+        routes=sample_synthesis_routes,
+        radius=0.5,
+        distance_metric=counting_metric,
+        num_tries=100,
+        random_state=random.Random(100),
+    )
+    assert len(computed_pairs) > 0
+    assert len(computed_pairs) == len(set(computed_pairs))
+
+
+@pytest.mark.parametrize(
+    "metric, threshold",
+    [
+        (molecule_jaccard_distance, 0.5),
+        (reaction_jaccard_distance, 0.5),
+        (molecule_symmetric_difference_distance, 2),
+        (reaction_symmetric_difference_distance, 4),
+    ],
+)
+def test_builtin_metric_matches_generic_metric(
+    sample_synthesis_routes: list[SynthesisGraph],
+    metric,
+    threshold: float,
+) -> None:
+    """
+    Test that the vectorized computation used for the built-in metrics gives the same result
+    as calling the metric on every pair of routes (which is what happens for an arbitrary function).
+    """
+
+    results = [
+        estimate_packing_number(
+            routes=sample_synthesis_routes,
+            radius=threshold,
+            distance_metric=distance_metric,
+            num_tries=10,
+            random_state=random.Random(100),
+        )
+        for distance_metric in (metric, lambda route1, route2: metric(route1, route2))
+    ]
+    assert results[0] == results[1]
+
+
+def test_duplicate_routes(sample_synthesis_routes: list[SynthesisGraph]) -> None:
+    """
+    Test that duplicate routes are removed before computing distances,
+    and that the first occurrence of each route is the one returned.
+    """
+
+    num_calls = 0
+
+    def counting_metric(route1: SynthesisGraph, route2: SynthesisGraph) -> float:
+        nonlocal num_calls
+        num_calls += 1
+        return reaction_jaccard_distance(route1, route2)
+
+    # Duplicates are copies (rather than the same objects) placed after the originals
+    duplicates = [
+        SynthesisGraph(route.root_node, incoming_graph_data=route._graph)
+        for route in sample_synthesis_routes
+    ]
+    distinct_routes = estimate_packing_number(
+        routes=sample_synthesis_routes + duplicates + duplicates,
+        radius=0,
+        distance_metric=counting_metric,
+        num_tries=100,
+        random_state=random.Random(100),
+    )
+    num_unique = len(sample_synthesis_routes)
+    assert len(distinct_routes) == num_unique
+    assert num_calls <= num_unique * (num_unique - 1) // 2
+    assert all(any(route is r for r in sample_synthesis_routes) for route in distinct_routes)
+
+
+def _wrapped_reaction_jaccard_distance(route1: SynthesisGraph, route2: SynthesisGraph) -> float:
+    """Same as `reaction_jaccard_distance`, but not recognized as a built-in metric."""
+    return reaction_jaccard_distance(route1, route2)
+
+
+@pytest.mark.parametrize("num_processes", [1, 2])
+def test_multiprocessing(sample_synthesis_routes: list[SynthesisGraph], num_processes: int) -> None:
+    """Test that computing distances in multiple processes does not change the result."""
+
+    results = [
+        estimate_packing_number(
+            routes=sample_synthesis_routes,
+            radius=0.5,
+            distance_metric=_wrapped_reaction_jaccard_distance,
+            num_tries=10,
+            random_state=random.Random(100),
+            num_processes=n,
+        )
+        for n in (0, num_processes)
+    ]
+    assert results[0] == results[1]
+
+
+def test_max_packing_number_avoids_distance_computations(
+    sample_synthesis_routes: list[SynthesisGraph],
+) -> None:
+    """
+    Test that when a max packing number is set, an arbitrary distance metric is only
+    evaluated when needed (e.g. not at all if only a single route is requested).
+    """
+
+    num_calls = 0
+
+    def counting_metric(route1: SynthesisGraph, route2: SynthesisGraph) -> float:
+        nonlocal num_calls
+        num_calls += 1
+        return reaction_jaccard_distance(route1, route2)
+
+    distinct_routes = estimate_packing_number(
+        routes=sample_synthesis_routes,
+        radius=1e-3,
+        distance_metric=counting_metric,
+        max_packing_number=1,
+        num_tries=100,
+        random_state=random.Random(100),
+    )
+    assert len(distinct_routes) == 1
+    assert num_calls == 0